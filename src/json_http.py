@@ -0,0 +1,14 @@
+import json
+from http.server import BaseHTTPRequestHandler
+
+
+# Base for the HTTP handlers here, all of which answer in JSON
+class JSONRequestHandler(BaseHTTPRequestHandler):
+    def send_json(self, status: int, body) -> None:
+        content = json.dumps(body, default=str).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
@@ -1,5 +1,7 @@
 import json
 import psycopg2.pool
+from typing import Union
+import query_cache
 import sql
 
 # Items that aren't logged in commodity tables because they cannot be traded
@@ -31,11 +33,9 @@ def log_commodity(name: str) -> bool:
 
 # Logs basic body information provided in FSDJump Journal
 def handle_fsd_jump_journal(message_json: json, pool: psycopg2.pool.ThreadedConnectionPool) -> \
-        tuple[str, list[str], str, str]:
+        tuple[str, list[str], Union[int, str], Union[int, str]]:
     payload = message_json["message"]
-    payload["BodyID"] = str(payload["BodyID"])
     payload["StarPos"] = [str(position_component) for position_component in payload["StarPos"]]
-    payload["SystemAddress"] = str(payload["SystemAddress"])
 
     if not sql.is_system_in_database(system_id=payload["SystemAddress"], pool=pool):
         sql.update_system_row(payload["StarSystem"], payload["SystemAddress"], payload["StarPos"], pool=pool)
@@ -57,11 +57,9 @@ def handle_fsd_jump_journal(message_json: json, pool: psycopg2.pool.ThreadedConn
 
 # Logs basic body information provided in Location Journal
 def handle_location_journal(message_json: json, pool: psycopg2.pool.ThreadedConnectionPool) -> \
-        tuple[str, list[str], str, str]:
+        tuple[str, list[str], Union[int, str], Union[int, str]]:
     payload = message_json["message"]
-    payload["BodyID"] = str(payload["BodyID"])
     payload["StarPos"] = [str(position_component) for position_component in payload["StarPos"]]
-    payload["SystemAddress"] = str(payload["SystemAddress"])
 
     if not sql.is_system_in_database(payload["SystemAddress"], pool=pool):
         sql.update_system_row(payload["StarSystem"], payload["SystemAddress"], payload["StarPos"], pool=pool)
@@ -70,7 +68,7 @@ def handle_location_journal(message_json: json, pool: psycopg2.pool.ThreadedConn
     body_information = (payload["Body"], payload["BodyID"], payload["SystemAddress"])
 
     distance = payload["DistFromStarLS"] if "DistFromStarLS" in payload.keys() else None
-    market_id = str(payload["MarketID"]) if "MarketID" in payload.keys() else None
+    market_id = payload["MarketID"] if "MarketID" in payload.keys() else None
 
     if body_type == "Star":
         if not sql.is_star_in_database(payload["SystemAddress"], payload["BodyID"], pool=pool) or \
@@ -92,12 +90,10 @@ def handle_location_journal(message_json: json, pool: psycopg2.pool.ThreadedConn
 
 # Logs complete body information provided in Scan Journal
 def handle_scan_journal(message_json: json, pool: psycopg2.pool.ThreadedConnectionPool) -> \
-        tuple[str, list[str], str, str]:
+        tuple[str, list[str], Union[int, str], Union[int, str]]:
     payload = message_json["message"]
-    payload["BodyID"] = str(payload["BodyID"])
-    payload["SystemAddress"] = str(payload["SystemAddress"])
 
-    body_information: tuple[str, str, list[str]] = (payload["BodyName"], payload["BodyID"], payload["SystemAddress"])
+    body_information: tuple[str, int, int] = (payload["BodyName"], payload["BodyID"], payload["SystemAddress"])
 
     distance = payload["DistanceFromArrivalLS"] if "DistanceFromArrivalLS" in payload.keys() else None
     planet_class = payload["PlanetClass"] if "PlanetClass" in payload.keys() else None
@@ -120,9 +116,9 @@ def handle_scan_journal(message_json: json, pool: psycopg2.pool.ThreadedConnecti
     return "Success", [], payload["SystemAddress"], payload["BodyID"]
 
 
-def handle_commodity(message_json: json, pool: psycopg2.pool.ThreadedConnectionPool) -> tuple[str, list[str], str, str]:
+def handle_commodity(message_json: json, pool: psycopg2.pool.ThreadedConnectionPool) -> \
+        tuple[str, list[str], Union[int, str], Union[int, str]]:
     payload = message_json["message"]
-    payload["marketId"] = str(payload["marketId"])
 
     if not sql.is_system_in_database(system_name=payload["systemName"], pool=pool) or \
             not sql.is_station_in_database(system_name=payload["systemName"], station_name=payload["stationName"],
@@ -136,14 +132,17 @@ def handle_commodity(message_json: json, pool: psycopg2.pool.ThreadedConnectionP
     if len(payload["commodities"]) == 0:
         return "Ignored", ["No commodities present"], system_id, body_id
 
-    for commodity in payload["commodities"]:
-        if log_commodity(commodity["name"]):
-            commodity_id = f"{payload['marketId']}_{commodity['name']}"
-
-            sql.update_commodity_row(commodity["name"], commodity_id, payload["marketId"], commodity["buyPrice"],
-                                     commodity["sellPrice"], commodity["meanPrice"], commodity["stock"],
-                                     commodity["demand"], pool=pool)
-        else:
-            meta_message.append(f"Ignoring untradable commodity {commodity['name']}")
+    # The market is invalidated once it is written, and also if a write fails partway so a half written market
+    # isn't left cached
+    try:
+        for commodity in payload["commodities"]:
+            if log_commodity(commodity["name"]):
+                sql.update_commodity_row(commodity["name"], payload["marketId"], commodity["buyPrice"],
+                                         commodity["sellPrice"], commodity["meanPrice"], commodity["stock"],
+                                         commodity["demand"], pool=pool)
+            else:
+                meta_message.append(f"Ignoring untradable commodity {commodity['name']}")
+    finally:
+        query_cache.invalidate(("market", payload["marketId"]))
 
     return "Success", meta_message, system_id, body_id
@@ -1,6 +1,9 @@
 import json
 from threading import Thread
 
+from migrations import finish_numeric_key_migration
+from profiling import run_admin_server
+from query_server import run_query_server
 from socketer import run_socket, log_queue_worker
 from sql import create_systems_table
 
@@ -23,12 +26,23 @@ def run():
             "function": run_socket,
             "count": 1
         },
+        {
+            "function": run_query_server,
+            "count": 1
+        },
+        {
+            "function": run_admin_server,
+            "count": 1
+        },
         # {
         #     "function": log_queue_worker,
         #     "count": queue_worker_thread_count
         # }
     ]
 
+    if not finish_numeric_key_migration():
+        return
+
     create_systems_table()
 
     processes = []
@@ -0,0 +1,306 @@
+import time
+
+import psycopg2
+import psycopg2.errors
+
+import sql
+
+"""
+Moves a database created with TEXT keys over to the numeric key schema in sql.table_definitions without taking the
+ingester offline. The migration runs in four phases, the first three of which are safe to interrupt and rerun:
+    1. Shadow tables ("<table>_numeric") are created next to the live tables.
+    2. A trigger on every live table mirrors each insert and update into its shadow table.
+    3. Existing rows are copied across in small keyset-ordered batches, each batch in its own transaction, and the
+       indexes in sql.index_definitions are then built concurrently on the shadow tables. The shadow tables are then
+       marked as ready.
+    4. The live and shadow tables are swapped by renaming them in one short transaction. The old tables are kept as
+       "<table>_legacy" so they can be checked and dropped by hand.
+Running this module carries out phases 1 to 3 while the old ingester keeps running. The swap is left to the ingester:
+once the old build is stopped, the numeric key build swaps the ready tables in main.run before it starts any workers,
+so no old build is ever left writing TEXT keys against the new tables.
+"""
+
+shadow_suffix = "_numeric"
+legacy_suffix = "_legacy"
+ready_comment = "numeric keys ready"
+
+# Copies the parent system of a newly written body ahead of the body itself, in case the backfill hasn't reached it yet
+system_prelude = f"INSERT INTO systems{shadow_suffix} SELECT name, system_id::BIGINT, location FROM systems " \
+                 "WHERE system_id = NEW.system_id ON CONFLICT (system_id) DO NOTHING;"
+
+# How to carry each live table over to its shadow table, in foreign key order. "keys" is the live primary key used to
+# walk the table, "columns" converts a live row (aliased "source") into a shadow row and "prelude" runs in the
+# trigger before the row is mirrored. "batch_prelude" runs against each backfill batch (aliased "batch") before it is
+# copied. Commodity names are only inserted when missing, since even a conflicting insert takes a value from the
+# SMALLSERIAL sequence and the trigger runs for every commodity row written.
+migrated_tables = [
+    {
+        "table": "systems",
+        "keys": ["system_id"],
+        "columns": "source.name, source.system_id::BIGINT, source.location",
+        "conflict": ["system_id"],
+        "updated": ["name", "location"]
+    },
+    {
+        "table": "abstract_bodies",
+        "keys": ["body_id", "system_id"],
+        "columns": "source.name, source.body_id::SMALLINT, source.system_id::BIGINT, source.body_type, "
+                   "source.distance",
+        "conflict": ["body_id", "system_id"],
+        "updated": ["name", "body_type", "distance"],
+        "prelude": system_prelude
+    },
+    {
+        "table": "stars",
+        "keys": ["body_id", "system_id"],
+        "columns": "source.name, source.body_id::SMALLINT, source.system_id::BIGINT, source.class, source.mass, "
+                   "source.distance",
+        "conflict": ["body_id", "system_id"],
+        "updated": ["name", "class", "mass", "distance"],
+        "prelude": system_prelude
+    },
+    {
+        "table": "planets",
+        "keys": ["body_id", "system_id"],
+        "columns": "source.name, source.body_id::SMALLINT, source.system_id::BIGINT, source.class, "
+                   "source.terraforming_state, source.mass, source.distance, source.is_discovered, source.is_mapped",
+        "conflict": ["body_id", "system_id"],
+        "updated": ["name", "class", "terraforming_state", "mass", "distance", "is_discovered", "is_mapped"],
+        "prelude": system_prelude
+    },
+    {
+        "table": "stations",
+        "keys": ["station_id"],
+        "columns": "source.name, source.body_id::SMALLINT, source.system_id::BIGINT, source.station_id::BIGINT, "
+                   "source.distance, source.station_type, source.last_updated",
+        "conflict": ["station_id"],
+        "updated": ["name", "body_id", "system_id", "distance", "station_type", "last_updated"],
+        "prelude": system_prelude
+    },
+    {
+        "table": "commodities",
+        "keys": ["commodity_id"],
+        "columns": f"source.station_id::BIGINT, (SELECT commodity_type_id FROM commodity_types{shadow_suffix} "
+                   "WHERE name = source.name), source.buy_price, source.sell_price, source.mean_price, "
+                   "source.units_in_stock, source.units_in_demand",
+        "conflict": ["station_id", "commodity_type_id"],
+        "updated": ["buy_price", "sell_price", "mean_price", "units_in_stock", "units_in_demand"],
+        "prelude": f"INSERT INTO commodity_types{shadow_suffix} (name) SELECT NEW.name WHERE NOT EXISTS ("
+                   f"SELECT 1 FROM commodity_types{shadow_suffix} WHERE name = NEW.name"
+                   ") ON CONFLICT (name) DO NOTHING;",
+        "batch_prelude": f"INSERT INTO commodity_types{shadow_suffix} (name) SELECT DISTINCT source.name "
+                         "FROM batch AS source WHERE NOT EXISTS ("
+                         f"SELECT 1 FROM commodity_types{shadow_suffix} WHERE name = source.name"
+                         ") ON CONFLICT (name) DO NOTHING"
+    }
+]
+
+
+# Runs a statement that needs a table lock, backing off instead of queueing the ingester's writes behind it
+def execute_with_lock_timeout(database: sql.SQLConnection, query: str, lock_timeout: str = "2s",
+                              retry_delay: float = 1) -> None:
+    while True:
+        try:
+            database.cursor.execute(f"SET lock_timeout = '{lock_timeout}';")
+            database.cursor.execute(query)
+            database.cursor.execute("SET lock_timeout = 0;")
+            return
+        except psycopg2.errors.LockNotAvailable:
+            if not database.connection.autocommit:
+                database.connection.rollback()
+
+            print(f"Timed out waiting for a lock, retrying in {retry_delay}s")
+            time.sleep(retry_delay)
+
+
+# Returns whether or not the database already uses numeric keys
+def is_numeric_key_schema(database: sql.SQLConnection) -> bool:
+    database.cursor.execute("SELECT data_type FROM information_schema.columns "
+                            "WHERE table_name = 'systems' AND column_name = 'system_id';")
+    data_type = database.cursor.fetchone()
+
+    return data_type is not None and data_type[0] == "bigint"
+
+
+# Creates the shadow tables that will replace the live tables
+def create_shadow_tables(database: sql.SQLConnection) -> None:
+    for table_name, columns in sql.table_definitions:
+        database.cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name}{shadow_suffix} "
+                                f"({columns.format(suffix=shadow_suffix)});")
+
+
+# Mirrors every write to the live tables into the shadow tables until the swap
+def create_sync_triggers(database: sql.SQLConnection) -> None:
+    for migration in migrated_tables:
+        table = migration["table"]
+        updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in migration["updated"])
+
+        database.cursor.execute(f"CREATE OR REPLACE FUNCTION {table}{shadow_suffix}_sync() RETURNS trigger AS $$ "
+                                f"BEGIN "
+                                f"{migration.get('prelude', '')} "
+                                f"INSERT INTO {table}{shadow_suffix} "
+                                f"SELECT {migration['columns']} FROM (SELECT NEW.*) AS source "
+                                f"ON CONFLICT ({', '.join(migration['conflict'])}) DO UPDATE SET {updates}; "
+                                f"RETURN NEW; "
+                                f"END; "
+                                f"$$ LANGUAGE plpgsql;")
+
+        execute_with_lock_timeout(database, f"DROP TRIGGER IF EXISTS {table}{shadow_suffix}_sync ON {table};"
+                                            f"CREATE TRIGGER {table}{shadow_suffix}_sync "
+                                            f"AFTER INSERT OR UPDATE ON {table} "
+                                            f"FOR EACH ROW EXECUTE PROCEDURE {table}{shadow_suffix}_sync();")
+
+
+# Copies the existing rows of every live table into its shadow table. Rows the trigger has already written are
+# newer than the copy, so they are left alone
+def backfill_shadow_tables(database: sql.SQLConnection, batch_size: int = 5000, batch_delay: float = 0) -> None:
+    for migration in migrated_tables:
+        table = migration["table"]
+        keys = ", ".join(migration["keys"])
+        last_key = None
+        copied_rows = 0
+
+        while True:
+            if last_key is None:
+                key_filter = ""
+                parameters = (batch_size,)
+            else:
+                key_filter = f"WHERE ({keys}) > ({', '.join(['%s'] * len(last_key))})"
+                parameters = (*last_key, batch_size)
+
+            batch = f"WITH batch AS (SELECT * FROM {table} {key_filter} ORDER BY {keys} LIMIT %s)"
+
+            # Rows written inside one statement aren't visible to the rest of it, so anything the copy looks up has
+            # to be registered by a statement of its own first
+            if "batch_prelude" in migration:
+                database.cursor.execute(f"{batch} {migration['batch_prelude']};", parameters)
+
+            database.cursor.execute(f"{batch}, copied AS ("
+                                    f"INSERT INTO {table}{shadow_suffix} "
+                                    f"SELECT {migration['columns']} FROM batch AS source "
+                                    f"ON CONFLICT ({', '.join(migration['conflict'])}) DO NOTHING"
+                                    f") "
+                                    f"SELECT {keys}, (SELECT COUNT(*) FROM batch) FROM batch "
+                                    f"ORDER BY {keys} DESC LIMIT 1;", parameters)
+            last_row = database.cursor.fetchone()
+
+            if last_row is None:
+                break
+
+            last_key = last_row[:-1]
+            copied_rows += last_row[-1]
+
+            if batch_delay:
+                time.sleep(batch_delay)
+
+        print(f"Copied {copied_rows} rows from {table}")
+        database.cursor.execute(f"ANALYZE {table}{shadow_suffix};")
+
+    database.cursor.execute(f"ANALYZE commodity_types{shadow_suffix};")
+
+
+# Builds the secondary indexes on the shadow tables without blocking the trigger's writes. They are given their final
+# names straight away since the live TEXT key tables never had them
+def build_shadow_indexes(database: sql.SQLConnection) -> None:
+    for index_name, table_name, index_method in sql.index_definitions:
+        # An interrupted concurrent build leaves an invalid index behind that IF NOT EXISTS would otherwise keep
+        database.cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s);", (index_name,))
+        index = database.cursor.fetchone()
+
+        if index is not None and not index[0]:
+            database.cursor.execute(f"DROP INDEX CONCURRENTLY {index_name};")
+
+        database.cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} "
+                                f"ON {table_name}{shadow_suffix} USING {index_method};")
+
+
+# Replaces the live tables with the shadow tables in a single transaction
+def swap_shadow_tables(database: sql.SQLConnection) -> None:
+    live_tables = [migration["table"] for migration in migrated_tables]
+    statements = [f"LOCK TABLE {', '.join(live_tables)} IN ACCESS EXCLUSIVE MODE;"]
+
+    for table in live_tables:
+        statements.append(f"DROP TRIGGER {table}{shadow_suffix}_sync ON {table};")
+        statements.append(f"DROP FUNCTION {table}{shadow_suffix}_sync();")
+        statements.append(f"ALTER TABLE {table} RENAME TO {table}{legacy_suffix};")
+
+    for table_name, _ in sql.table_definitions:
+        statements.append(f"ALTER TABLE {table_name}{shadow_suffix} RENAME TO {table_name};")
+
+    statements.append("COMMENT ON TABLE systems IS NULL;")
+
+    database.connection.autocommit = False
+
+    try:
+        execute_with_lock_timeout(database, "".join(statements))
+        database.connection.commit()
+    finally:
+        database.connection.autocommit = True
+
+
+# Returns whether or not the database still has the TEXT key tables
+def is_text_key_schema(database: sql.SQLConnection) -> bool:
+    database.cursor.execute("SELECT data_type FROM information_schema.columns "
+                            "WHERE table_name = 'systems' AND column_name = 'system_id';")
+    data_type = database.cursor.fetchone()
+
+    return data_type is not None and data_type[0] == "text"
+
+
+# Returns whether or not the shadow tables have been fully backfilled and indexed
+def are_shadow_tables_ready(database: sql.SQLConnection) -> bool:
+    database.cursor.execute("SELECT obj_description(to_regclass(%s), 'pg_class');", (f"systems{shadow_suffix}",))
+
+    return database.cursor.fetchone()[0] == ready_comment
+
+
+# Copies the live tables into shadow tables while the database stays in use, leaving the swap to the ingester
+def migrate_to_numeric_keys(batch_size: int = 5000, batch_delay: float = 0) -> None:
+    database = None
+
+    try:
+        database = sql.SQLConnection(sql.database_login_info)
+
+        if is_numeric_key_schema(database):
+            print("Database already uses numeric keys")
+            return
+
+        create_shadow_tables(database)
+        create_sync_triggers(database)
+        backfill_shadow_tables(database, batch_size, batch_delay)
+        build_shadow_indexes(database)
+
+        database.cursor.execute(f"COMMENT ON TABLE systems{shadow_suffix} IS '{ready_comment}';")
+
+        print("Shadow tables are ready, stop the ingester and start the numeric key build to swap them in")
+    finally:
+        if database:
+            database.close()
+
+
+# Swaps in the shadow tables left by migrate_to_numeric_keys. Called by the ingester before any workers start, so
+# no build that still writes TEXT keys is running. Returns whether or not the database can be used with numeric keys
+def finish_numeric_key_migration() -> bool:
+    database = None
+
+    try:
+        database = sql.SQLConnection(sql.database_login_info)
+
+        if not is_text_key_schema(database):
+            return True
+
+        if not are_shadow_tables_ready(database):
+            print("The database still uses TEXT keys, run migrations.py to completion before starting this build")
+            return False
+
+        swap_shadow_tables(database)
+
+        print(f"Swapped in the numeric key tables, the old tables are kept with the {legacy_suffix} suffix")
+        return True
+    finally:
+        if database:
+            database.close()
+
+
+if __name__ == "__main__":
+    migrate_to_numeric_keys()
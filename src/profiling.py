@@ -0,0 +1,244 @@
+import copy
+import cProfile
+import json
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from json_http import JSONRequestHandler
+
+with open("config.json") as config_file:
+    config_json = json.load(config_file)
+
+    enabled = config_json.get("Profiling Enabled", False)
+    sample_rate = config_json.get("Profiling Sample Rate", 0.01)
+    slow_message_seconds = config_json.get("Slow Message Seconds", 1.0)
+    slow_message_file = config_json.get("Slow Message Capture File", "slow_messages.jsonl")
+    profile_stats_file = config_json.get("Profile Stats File", "ingestion.prof")
+    admin_server_port = config_json.get("Admin Server Port", 8081)
+    replay_login_info = config_json.get("Replay SQL Login")
+
+
+"""
+Profiling mode for the ingestion hot path, switched on with the "Profiling Enabled" configuration key or at runtime
+with POST /profiling?enabled=<true|false> on the admin server, which only listens on localhost. While it is on:
+    Every handler and SQL statement run for a message is timed.
+    A sample of messages is run under cProfile, with the combined stats written to the profile stats file.
+    Messages slower than the slow message threshold are appended, unmodified, to the capture file together with their
+    timings.
+Running this module with a capture file feeds the messages through socketer.handle_task again and prints their new
+timings next to the captured ones. Replays write into the database given by the "Replay SQL Login" configuration key,
+which must not be the live database.
+"""
+
+# Timings of the message being handled by the current thread, None when it isn't being profiled, and the timings of
+# the last message it finished
+message_state = threading.local()
+
+# Replays turn this off so slow replayed messages aren't captured again
+capture_enabled = True
+
+# cProfile can only follow one thread at a time
+profiler_lock = threading.Lock()
+profile_stats = None
+profile_stats_lock = threading.Lock()
+capture_lock = threading.Lock()
+
+
+# Turns profiling on or off for messages that arrive from now on
+def set_enabled(is_enabled: bool) -> None:
+    global enabled
+
+    enabled = is_enabled
+
+
+# Adds a timing to the message being profiled on this thread, if there is one
+def record(name: str, seconds: float) -> None:
+    timings = getattr(message_state, "timings", None)
+
+    if timings is not None:
+        timings.append((name, seconds))
+
+
+@contextmanager
+def timed(name: str):
+    if getattr(message_state, "timings", None) is None:
+        yield
+        return
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+# Profiles the handling of a message when profiling is enabled
+@contextmanager
+def profiled_message(task_name: str, message_json: json):
+    if not enabled:
+        yield
+        return
+
+    # Handlers rewrite parts of the payload, so the capture needs the message as it arrived
+    original_message = copy.deepcopy(message_json)
+    message_state.timings = []
+
+    profiler = None
+
+    if random.random() < sample_rate and profiler_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        latency = time.perf_counter() - start
+        timings = message_state.timings
+        message_state.timings = None
+        message_state.last_timings = timings
+
+        if profiler is not None:
+            profiler.disable()
+            profiler_lock.release()
+            add_profile(profiler)
+
+        if capture_enabled and latency >= slow_message_seconds:
+            capture_message(task_name, original_message, latency, timings)
+
+
+# Merges a sampled profile into the combined stats file
+def add_profile(profiler: cProfile.Profile) -> None:
+    global profile_stats
+
+    with profile_stats_lock:
+        if profile_stats is None:
+            profile_stats = pstats.Stats(profiler)
+        else:
+            profile_stats.add(profiler)
+
+        profile_stats.dump_stats(profile_stats_file)
+
+
+# Appends a slow message and its timings to the capture file
+def capture_message(task_name: str, message_json: json, latency: float, timings: list[tuple[str, float]]) -> None:
+    capture = {
+        "task_name": task_name,
+        "message": message_json,
+        "latency": latency,
+        "timings": timings,
+        "captured": datetime.now(timezone.utc).isoformat()
+    }
+
+    with capture_lock:
+        with open(slow_message_file, "a") as capture_file:
+            capture_file.write(json.dumps(capture, default=str) + "\n")
+
+
+# Returns the host, port and database name a set of login details connects to
+def get_database_identity(login_info: dict) -> tuple:
+    return (login_info.get("host", os.environ.get("PGHOST", "localhost")),
+            str(login_info.get("port", os.environ.get("PGPORT", 5432))),
+            login_info.get("dbname", login_info.get("database")))
+
+
+# Returns the total time spent on each timed name, in the order the names were first seen
+def sum_timings(timings: list) -> dict[str, float]:
+    totals = {}
+
+    for name, seconds in timings:
+        totals[name] = totals.get(name, 0) + seconds
+
+    return totals
+
+
+# Feeds every message in a capture file back through the ingestion pipeline, printing each handler and statement
+# timing next to the one captured. Captured snapshots are out of date, so they are only ever written to the separate
+# replay database
+def replay_captures(capture_filename: str) -> None:
+    import profiling
+    import sql
+
+    if replay_login_info is None:
+        print("Set \"Replay SQL Login\" in config.json to the database captures should be replayed into")
+        return
+
+    if get_database_identity(replay_login_info) == get_database_identity(sql.database_login_info):
+        print("Refusing to replay captures into the live database")
+        return
+
+    # sql only connects to the live database on first use, so switching before anything runs keeps replays off it
+    sql.use_database(replay_login_info, 1, 2)
+
+    import socketer
+
+    # Timings stay on, but replayed messages that are still slow must not be captured into the file being replayed,
+    # and sampled profiles must not overwrite the live process's stats. This goes through the imported module since
+    # sql and socketer don't see __main__ when this file is run directly
+    profiling.capture_enabled = False
+    profiling.sample_rate = 0
+    profiling.set_enabled(True)
+
+    with open(capture_filename) as capture_file:
+        captures = [json.loads(line) for line in capture_file]
+
+    for capture in captures:
+        start = time.perf_counter()
+
+        # Handlers that raised are captured too, and one of them mustn't end the replay
+        try:
+            socketer.handle_task(capture["task_name"], capture["message"])
+        except Exception as e:
+            print(f"{capture['task_name']} failed: {e}")
+
+        latency = time.perf_counter() - start
+
+        print(f"{capture['task_name']} took {latency:.3f}s, captured at {capture['latency']:.3f}s")
+
+        captured_timings = sum_timings(capture["timings"])
+        replayed_timings = sum_timings(getattr(profiling.message_state, "last_timings", None) or [])
+
+        for name in {**replayed_timings, **captured_timings}:
+            print(f"    {replayed_timings.get(name, 0):.3f}s (captured {captured_timings.get(name, 0):.3f}s) {name}")
+
+
+class ProfilingRequestHandler(JSONRequestHandler):
+    def do_POST(self):
+        url = urlparse(self.path)
+
+        if url.path != "/profiling":
+            self.send_json(404, {"error": "Unknown action"})
+            return
+
+        is_enabled = parse_qs(url.query).get("enabled", [""])[0].lower()
+
+        if is_enabled not in ("true", "false"):
+            self.send_json(400, {"error": "enabled must be true or false"})
+            return
+
+        set_enabled(is_enabled == "true")
+        self.send_json(200, {"enabled": enabled})
+
+
+# Serves the profiling toggle to this machine only, apart from the query server other tools can reach
+def run_admin_server() -> None:
+    server = HTTPServer(("127.0.0.1", admin_server_port), ProfilingRequestHandler)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    replay_captures(sys.argv[1] if len(sys.argv) > 1 else slow_message_file)
@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+"""
+In-process cache for the query service. Entries are keyed by tuples such as ("station", station_id), and the writers
+invalidate the key of every row they touch so reads never outlive a write by more than the time it takes to reload
+them. Entries also expire after their time to live, which covers lookups that can't be invalidated by key.
+"""
+
+maximum_entries = 50000
+
+
+class Load:
+    def __init__(self):
+        self.finished = threading.Event()
+        self.value = None
+        self.error = None
+        self.is_invalidated = False
+
+
+# Key -> (value, expiry)
+entries: OrderedDict = OrderedDict()
+# Key -> the load filling it, so concurrent misses on one key share a single query
+loads: dict[tuple, Load] = {}
+entries_lock = threading.Lock()
+
+
+# Returns the cached value of the key, calling loader to fill it on a miss
+def get(key: tuple, loader: Callable[[], Any], time_to_live: float) -> Any:
+    with entries_lock:
+        entry = entries.get(key)
+
+        if entry is not None and entry[1] > time.monotonic():
+            entries.move_to_end(key)
+            return entry[0]
+
+        load = loads.get(key)
+        is_loader = load is None
+
+        if is_loader:
+            load = Load()
+            loads[key] = load
+
+    if not is_loader:
+        load.finished.wait()
+
+        if load.error is not None:
+            raise load.error
+
+        return load.value
+
+    try:
+        load.value = loader()
+    except Exception as e:
+        load.error = e
+        raise
+    finally:
+        # The value is only kept if nothing invalidated the key while it was loading, otherwise it may already be stale
+        with entries_lock:
+            if loads.get(key) is load:
+                del loads[key]
+
+            if load.error is None and not load.is_invalidated:
+                entries[key] = (load.value, time.monotonic() + time_to_live)
+                entries.move_to_end(key)
+
+                while len(entries) > maximum_entries:
+                    entries.popitem(last=False)
+
+        load.finished.set()
+
+    return load.value
+
+
+# Drops the cached value of each key. Readers already waiting on a load still get its result, later readers reload
+def invalidate(*keys: tuple) -> None:
+    with entries_lock:
+        for key in keys:
+            entries.pop(key, None)
+            load = loads.pop(key, None)
+
+            if load is not None:
+                load.is_invalidated = True
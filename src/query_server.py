@@ -0,0 +1,127 @@
+import json
+import math
+import re
+import threading
+from http.server import ThreadingHTTPServer
+from typing import Any, Callable
+from urllib.parse import parse_qs, urlparse
+
+import psycopg2.pool
+
+import query_cache
+import sql
+from json_http import JSONRequestHandler
+
+with open("config.json") as config_file:
+    config_json = json.load(config_file)
+
+    query_server_address = config_json.get("Query Server Address", "127.0.0.1")
+    query_server_port = config_json.get("Query Server Port", 8080)
+    query_cache_seconds = config_json.get("Query Cache Seconds", 60)
+    query_server_connection_count = config_json.get("Query Server Connections", 4)
+
+
+"""
+Read-only HTTP lookups served from query_cache. Every response is JSON:
+    GET /systems/<system_id> - The system and its stations.
+    GET /systems/<system_id>/nearby?radius=<ly>&limit=<count> - Systems within radius light years, nearest first.
+    GET /stations/<station_id> - The station.
+    GET /stations/<station_id>/market - The commodities last logged at the station.
+"""
+
+maximum_nearby_radius = 100
+maximum_nearby_limit = 500
+
+# Lookups get their own connections so read traffic can never take the ingester's out of its pool. The pool raises
+# rather than waits when it runs dry, so loads queue on the semaphore instead
+query_connection_pool = psycopg2.pool.ThreadedConnectionPool(1, query_server_connection_count,
+                                                             **sql.database_login_info)
+query_connection_slots = threading.BoundedSemaphore(query_server_connection_count)
+
+
+# Runs a sql read function on one of the query server's connections
+def load(function: Callable, *arguments) -> Any:
+    with query_connection_slots:
+        return function(*arguments, pool=query_connection_pool)
+
+
+# Returns the cached system, reloading it after the ingester touches the system or one of its stations
+def lookup_system(system_id: int, _: dict) -> dict:
+    return query_cache.get(("system", system_id), lambda: load(sql.get_system, system_id), query_cache_seconds)
+
+
+# Nearby results depend on every system around the origin so they are only ever refreshed by expiry
+def lookup_nearby_systems(system_id: int, query: dict) -> list[dict]:
+    radius = float(query.get("radius", ["20"])[0])
+    limit = int(query.get("limit", ["100"])[0])
+
+    if not math.isfinite(radius) or radius < 0:
+        raise ValueError("radius must be a non-negative number")
+
+    if limit < 0:
+        raise ValueError("limit must not be negative")
+
+    radius = min(radius, maximum_nearby_radius)
+    limit = min(limit, maximum_nearby_limit)
+
+    return query_cache.get(("nearby", system_id, radius, limit),
+                           lambda: load(sql.get_nearby_systems, system_id, radius, limit), query_cache_seconds)
+
+
+def lookup_station(station_id: int, _: dict) -> dict:
+    return query_cache.get(("station", station_id), lambda: load(sql.get_station, station_id), query_cache_seconds)
+
+
+def lookup_market(station_id: int, _: dict) -> list[dict]:
+    return query_cache.get(("market", station_id), lambda: load(sql.get_market, station_id), query_cache_seconds)
+
+
+routes = [
+    (re.compile(r"^/systems/(\d+)$"), lookup_system),
+    (re.compile(r"^/systems/(\d+)/nearby$"), lookup_nearby_systems),
+    (re.compile(r"^/stations/(\d+)$"), lookup_station),
+    (re.compile(r"^/stations/(\d+)/market$"), lookup_market)
+]
+
+
+class QueryRequestHandler(JSONRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        for pattern, lookup in routes:
+            match = pattern.match(url.path)
+
+            if match is None:
+                continue
+
+            try:
+                result = lookup(int(match.group(1)), parse_qs(url.query))
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            except Exception as e:
+                print(f"Query {self.path} failed: {e}")
+                self.send_json(500, {"error": "Query failed"})
+                return
+
+            if result is None:
+                self.send_json(404, {"error": "Not logged"})
+            else:
+                self.send_json(200, result)
+
+            return
+
+        self.send_json(404, {"error": "Unknown lookup"})
+
+    # Requests arrive far too often to print each one
+    def log_message(self, format, *args):
+        pass
+
+
+def run_query_server() -> None:
+    server = ThreadingHTTPServer((query_server_address, query_server_port), QueryRequestHandler)
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
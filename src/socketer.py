@@ -1,10 +1,15 @@
+import itertools
 import json
 import queue
 import threading
 import zlib
 import zmq
+from collections import OrderedDict
+from datetime import datetime
+from typing import Union
 
 import loggers
+import profiling
 import schema_validation
 import sql
 
@@ -15,44 +20,155 @@ relay = "tcp://eddn.edcd.io:9500"
 
 context = zmq.Context()
 
-socket = context.socket(zmq.SUB)
-socket.connect(relay)
-socket.set(zmq.SUBSCRIBE, b"")
-
 # system_logging_queue = queue.Queue(2000)
 
+# Messages waiting on a row key that is already being written, keyed by row key and then by snapshot. A newer commodity
+# snapshot replaces a pending one for the same market, so only the freshest state of a market is written. Other
+# messages get a unique number as their identity so they are all handled
+pending_messages: dict[tuple, OrderedDict] = {}
+superseded_messages: dict[tuple, list[tuple[str, json]]] = {}
+mailbox_lock = threading.Lock()
+message_numbers = itertools.count()
+
 
 def handle_task(task_name: str, message_json: json) -> None:
-    is_valid_message, error = schema_validation.validate_message(message_json)
-
-    status = ""
-    meta_message = ["An unknown error occurred"]
-    system_of_interest = ""
-    body_of_interest = ""
-
-    if is_valid_message:
-        function = None
-
-        if task_name == "Commodity":
-            function = loggers.handle_commodity
-        elif task_name == "journal/FSDJump":
-            function = loggers.handle_fsd_jump_journal
-        elif task_name == "journal/Location":
-            function = loggers.handle_location_journal
-        elif task_name == "journal/Scan":
-            function = loggers.handle_scan_journal
+    with profiling.profiled_message(task_name, message_json):
+        with profiling.timed("schema_validation.validate_message"):
+            is_valid_message, error = schema_validation.validate_message(message_json)
+
+        status = ""
+        meta_message = ["An unknown error occurred"]
+        system_of_interest = ""
+        body_of_interest = ""
+
+        if is_valid_message:
+            function = None
+
+            if task_name == "Commodity":
+                function = loggers.handle_commodity
+            elif task_name == "journal/FSDJump":
+                function = loggers.handle_fsd_jump_journal
+            elif task_name == "journal/Location":
+                function = loggers.handle_location_journal
+            elif task_name == "journal/Scan":
+                function = loggers.handle_scan_journal
+            else:
+                status, meta_message = "Ignored", ["Invalid task name provided"]
+                print(f"Got invalid task name {task_name}")
+
+            if function is not None:
+                with profiling.timed(f"loggers.{function.__name__}"):
+                    status, meta_message, system_of_interest, body_of_interest = \
+                        function(message_json, sql.get_connection_pool())
         else:
-            status, meta_message = "Ignored", ["Invalid task name provided"]
-            print(f"Got invalid task name {task_name}")
+            status, meta_message = "Ignored", [f"{error}"]
+            print(f"Schema rejected: {error}")
+
+        with profiling.timed("sql.insert_log_row"):
+            sql.insert_log_row(status, meta_message, task_name, str(message_json), system_of_interest,
+                               body_of_interest, pool=sql.get_connection_pool())
+
+
+# Returns the upload time of a message, or None if it is missing or can't be read
+def get_message_timestamp(message_json: json) -> Union[datetime, None]:
+    payload = message_json.get("message") if isinstance(message_json, dict) else None
+    timestamp = payload.get("timestamp") if isinstance(payload, dict) else None
+
+    try:
+        return datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+
+
+# Returns whether or not the first message is an older snapshot than the second. Messages without readable timestamps
+# fall back to arrival order
+def is_older_snapshot(message_json: json, other_message_json: json) -> bool:
+    timestamp = get_message_timestamp(message_json)
+    other_timestamp = get_message_timestamp(other_message_json)
+
+    if timestamp is None or other_timestamp is None:
+        return False
+
+    try:
+        return timestamp < other_timestamp
+    except TypeError:
+        return False
+
+
+# Returns the row key a message writes to and, for full snapshots, the identity a newer snapshot replaces. Journal
+# events each carry their own subset of fields, so they are serialized per system but never replaced. Messages are
+# read defensively since they haven't been through schema validation yet
+def get_message_keys(task_name: str, message_json: json) -> tuple[tuple, Union[tuple, None]]:
+    payload = message_json.get("message") if isinstance(message_json, dict) else None
+
+    if not isinstance(payload, dict):
+        return ("malformed",), None
+
+    if task_name == "Commodity":
+        market_id = payload.get("marketId")
+
+        return (("market", market_id), (task_name,)) if isinstance(market_id, int) else (("malformed",), None)
 
-        if function is not None:
-            status, meta_message, system_of_interest, body_of_interest = function(message_json, sql.connection_pool)
-    else:
-        status, meta_message = "Ignored", [f"{error}"]
-        print(f"Schema rejected: {error}")
+    system_address = payload.get("SystemAddress")
 
-    sql.insert_log_row(status, meta_message, task_name, str(message_json), system_of_interest, body_of_interest,
-                       pool=sql.connection_pool)
+    return (("system", system_address), None) if isinstance(system_address, int) else (("malformed",), None)
+
+
+# Hands the message to the worker for its row key, starting one if that key is idle
+def post_message(task_name: str, message_json: json) -> None:
+    row_key, snapshot_identity = get_message_keys(task_name, message_json)
+
+    if snapshot_identity is None:
+        snapshot_identity = next(message_numbers)
+
+    with mailbox_lock:
+        mailbox = pending_messages.get(row_key)
+
+        if mailbox is not None:
+            pending_message = mailbox.get(snapshot_identity)
+
+            if pending_message is None:
+                mailbox[snapshot_identity] = (task_name, message_json)
+            elif is_older_snapshot(message_json, pending_message[1]):
+                superseded_messages[row_key].append((task_name, message_json))
+            else:
+                superseded_messages[row_key].append(pending_message)
+                mailbox[snapshot_identity] = (task_name, message_json)
+
+            return
+
+        pending_messages[row_key] = OrderedDict({snapshot_identity: (task_name, message_json)})
+        superseded_messages[row_key] = []
+
+    process = threading.Thread(target=drain_mailbox, args=(row_key,))
+    process.start()
+
+
+# Handles the messages for one row key one at a time until none are left
+def drain_mailbox(row_key: tuple) -> None:
+    while True:
+        with mailbox_lock:
+            mailbox = pending_messages[row_key]
+            superseded = superseded_messages[row_key]
+            superseded_messages[row_key] = []
+
+            if not mailbox and not superseded:
+                del pending_messages[row_key]
+                del superseded_messages[row_key]
+                return
+
+            message = mailbox.popitem(last=False)[1] if mailbox else None
+
+        for task_name, message_json in superseded:
+            sql.insert_log_row("Ignored", ["Superseded by a newer snapshot"], task_name, str(message_json), "", "",
+                               pool=sql.get_connection_pool())
+
+        # A failed message must not stop the worker, otherwise later messages for this key are never handled
+        if message is not None:
+            try:
+                handle_task(*message)
+            except Exception as e:
+                print(f"Failed to handle {message[0]}: {e}")
 
 
 def log_queue_worker() -> None:
@@ -64,6 +180,11 @@ def log_queue_worker() -> None:
 
 
 def run_socket() -> None:
+    # Subscribing here rather than on import keeps replays and other users of handle_task off the relay
+    socket = context.socket(zmq.SUB)
+    socket.connect(relay)
+    socket.set(zmq.SUBSCRIBE, b"")
+
     try:
         while True:
             message_binary = bytes(socket.recv())
@@ -91,7 +212,6 @@ def run_socket() -> None:
                     # system_logging_queue.put(("journal/Scan", message_json))
 
             if message_type is not None:
-                process = threading.Thread(target=handle_task, args=(message_type, message_json))
-                process.start()
+                post_message(message_type, message_json)
     except zmq.ZMQError:
         socket.disconnect(relay)
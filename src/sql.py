@@ -1,8 +1,13 @@
 import psycopg2
 import psycopg2.pool
+import threading
 import time
 import json
 from datetime import datetime, timezone
+from typing import Union
+
+import profiling
+import query_cache
 
 with open("config.json") as config_file:
     config_json = json.load(config_file)
@@ -11,12 +16,38 @@ with open("config.json") as config_file:
     queue_worker_thread_count = config_json["Worker Thread Count"]
 
 
-connection_pool = psycopg2.pool.ThreadedConnectionPool(queue_worker_thread_count, queue_worker_thread_count*3,
-                                                       **database_login_info)
+# The ingester's pool is only connected on first use, so importing this module opens no connections
+connection_pool = None
+connection_pool_lock = threading.Lock()
+
+
+# Returns the pool shared by the ingester, connecting it if this is the first use
+def get_connection_pool() -> psycopg2.pool.ThreadedConnectionPool:
+    global connection_pool
+
+    if connection_pool is None:
+        with connection_pool_lock:
+            if connection_pool is None:
+                connection_pool = psycopg2.pool.ThreadedConnectionPool(queue_worker_thread_count,
+                                                                       queue_worker_thread_count*3,
+                                                                       **database_login_info)
+
+    return connection_pool
+
+
+# Points every later query at another database, such as the one capture replays are written into
+def use_database(login_info: dict, minimum_connections: int, maximum_connections: int) -> None:
+    global database_login_info, connection_pool
+
+    with connection_pool_lock:
+        database_login_info = login_info
+        connection_pool = psycopg2.pool.ThreadedConnectionPool(minimum_connections, maximum_connections,
+                                                               **login_info)
 
 
 class SQLConnection:
     def __init__(self, credentials: dict[str, str], pool: psycopg2.pool.ThreadedConnectionPool = None):
+        start = time.perf_counter()
         connection = None
         cursor = None
         success = False
@@ -42,9 +73,12 @@ class SQLConnection:
         self.cursor = cursor
         self.connection_pool = pool
 
+        profiling.record("connect", time.perf_counter() - start)
+
     def execute(self, query, parameters=None) -> tuple:
         try:
-            return self.cursor.execute(query, parameters)
+            with profiling.timed(query):
+                return self.cursor.execute(query, parameters)
         except (psycopg2.OperationalError, AttributeError) as e:
             print(e)
             return tuple(),
@@ -60,6 +94,70 @@ class SQLConnection:
                 self.connection_pool.putconn(self.connection)
 
 
+# Keyed tables in creation order. References are written against "{suffix}" so the same definitions can build the
+# shadow tables used by migrations.migrate_to_numeric_keys alongside the live ones
+table_definitions = [
+    ("systems", "name TEXT,"
+                "system_id BIGINT,"
+                "location geometry,"
+                "PRIMARY KEY (system_id)"),
+    ("abstract_bodies", "name TEXT,"
+                        "body_id SMALLINT,"
+                        "system_id BIGINT REFERENCES systems{suffix}(system_id),"
+                        "body_type TEXT,"
+                        "distance FLOAT,"
+                        "PRIMARY KEY (body_id, system_id)"),
+    ("stars", "name TEXT,"
+              "body_id SMALLINT,"
+              "system_id BIGINT REFERENCES systems{suffix}(system_id),"
+              "class TEXT,"
+              "mass FLOAT,"
+              "distance FLOAT,"
+              "PRIMARY KEY (body_id, system_id)"),
+    ("planets", "name TEXT,"
+                "body_id SMALLINT,"
+                "system_id BIGINT REFERENCES systems{suffix}(system_id),"
+                "class TEXT,"
+                "terraforming_state TEXT,"
+                "mass FLOAT,"
+                "distance FLOAT,"
+                "is_discovered BOOL,"
+                "is_mapped BOOL,"
+                "PRIMARY KEY (body_id, system_id)"),
+    ("stations", "name TEXT,"
+                 "body_id SMALLINT,"
+                 "system_id BIGINT REFERENCES systems{suffix}(system_id),"
+                 "station_id BIGINT,"
+                 "distance FLOAT,"
+                 "station_type TEXT,"
+                 "last_updated TIMESTAMP,"
+                 "PRIMARY KEY (station_id)"),
+    ("commodity_types", "commodity_type_id SMALLSERIAL,"
+                        "name TEXT NOT NULL UNIQUE,"
+                        "PRIMARY KEY (commodity_type_id)"),
+    ("commodities", "station_id BIGINT,"
+                    "commodity_type_id SMALLINT REFERENCES commodity_types{suffix}(commodity_type_id),"
+                    "buy_price INT,"
+                    "sell_price INT,"
+                    "mean_price INT,"
+                    "units_in_stock INT,"
+                    "units_in_demand INT,"
+                    "PRIMARY KEY (station_id, commodity_type_id)")
+]
+
+# Indexes created alongside table_definitions, as (index name, table name, index method and columns). The GiST index
+# lets nearby system lookups use ST_3DDWithin without scanning every system, and the stations index serves station
+# lookups by system
+index_definitions = [
+    ("systems_location_index", "systems", "GIST (location gist_geometry_ops_nd)"),
+    ("stations_system_index", "stations", "BTREE (system_id)")
+]
+
+# Commodity names never change ids once assigned, so they are resolved once per process
+commodity_type_ids: dict[str, int] = {}
+commodity_type_ids_lock = threading.Lock()
+
+
 # Writes the system table to the database supplied in configuration
 def create_systems_table():
     database = None
@@ -69,67 +167,11 @@ def create_systems_table():
 
         database.cursor.execute("CREATE EXTENSION postgis;")
 
-        database.cursor.execute("CREATE TABLE systems ("
-                                "name TEXT,"
-                                "system_id TEXT,"
-                                "location geometry,"
-                                "PRIMARY KEY (system_id)"
-                                ");")
-
-        database.cursor.execute("CREATE TABLE abstract_bodies ("
-                                "name TEXT,"
-                                "body_id TEXT,"
-                                "system_id TEXT REFERENCES systems(system_id),"
-                                "body_type TEXT,"
-                                "distance FLOAT,"
-                                "PRIMARY KEY (body_id, system_id)"
-                                ");")
-
-        database.cursor.execute("CREATE TABLE stars ("
-                                "name TEXT,"
-                                "body_id TEXT,"
-                                "system_id TEXT REFERENCES systems(system_id),"
-                                "class TEXT,"
-                                "mass FLOAT,"
-                                "distance FLOAT,"
-                                "PRIMARY KEY (body_id, system_id)"
-                                ");")
-
-        database.cursor.execute("CREATE TABLE planets ("
-                                "name TEXT,"
-                                "body_id TEXT,"
-                                "system_id TEXT REFERENCES systems(system_id),"
-                                "class TEXT,"
-                                "terraforming_state TEXT,"
-                                "mass FLOAT,"
-                                "distance FLOAT,"
-                                "is_discovered BOOL,"
-                                "is_mapped BOOL,"
-                                "PRIMARY KEY (body_id, system_id)"
-                                ");")
-
-        database.cursor.execute("CREATE TABLE stations ("
-                                "name TEXT,"
-                                "body_id TEXT,"
-                                "system_id TEXT REFERENCES systems(system_id),"
-                                "station_id TEXT,"
-                                "distance FLOAT,"
-                                "station_type TEXT,"
-                                "last_updated TIMESTAMP,"
-                                "PRIMARY KEY (station_id)"
-                                ");")
+        for table_name, columns in table_definitions:
+            database.cursor.execute(f"CREATE TABLE {table_name} ({columns.format(suffix='')});")
 
-        database.cursor.execute("CREATE TABLE commodities ("
-                                "name TEXT,"
-                                "commodity_id TEXT,"
-                                "station_id TEXT,"
-                                "buy_price INT,"
-                                "sell_price INT,"
-                                "mean_price INT,"
-                                "units_in_stock INT,"
-                                "units_in_demand INT,"
-                                "PRIMARY KEY (commodity_id)"
-                                ");")
+        for index_name, table_name, index_method in index_definitions:
+            database.cursor.execute(f"CREATE INDEX {index_name} ON {table_name} USING {index_method};")
 
         database.cursor.execute("CREATE TABLE logs ("
                                 "status TEXT,"
@@ -148,7 +190,7 @@ def create_systems_table():
 
 
 # Checks to see if the specified system exists in the database
-def is_system_in_database(system_id: str = None, system_name: str = None,
+def is_system_in_database(system_id: int = None, system_name: str = None,
                           pool: psycopg2.pool.ThreadedConnectionPool = None) -> bool:
     database = SQLConnection(database_login_info, pool)
 
@@ -162,7 +204,7 @@ def is_system_in_database(system_id: str = None, system_name: str = None,
 
 
 # Check to see if the specified star exists in the database
-def is_star_in_database(system_id: str = None, body_id: str = None, star_name: str = None,
+def is_star_in_database(system_id: int = None, body_id: int = None, star_name: str = None,
                         pool: psycopg2.pool.ThreadedConnectionPool = None) -> bool:
     assert system_id is not None and (body_id is not None or star_name is not None), \
         "You must specify a valid method of identifying the star"
@@ -178,7 +220,7 @@ def is_star_in_database(system_id: str = None, body_id: str = None, star_name: s
 
 
 # Check to see if the specified planet exists in the database
-def is_planet_in_database(system_id: str = None, body_id: str = None, planet_name: str = None,
+def is_planet_in_database(system_id: int = None, body_id: int = None, planet_name: str = None,
                           pool: psycopg2.pool.ThreadedConnectionPool = None) -> bool:
     assert system_id is not None and (body_id is not None or planet_name is not None), \
         "You must specify a valid method of identifying the planet"
@@ -194,7 +236,7 @@ def is_planet_in_database(system_id: str = None, body_id: str = None, planet_nam
 
 
 # Check to see if the specified station exists in the database
-def is_station_in_database(system_id: str = None, system_name: str = None, station_name: str = None,
+def is_station_in_database(system_id: int = None, system_name: str = None, station_name: str = None,
                            pool: psycopg2.pool.ThreadedConnectionPool = None):
     assert (system_id is not None or system_name is not None) and station_name is not None, \
         "You must specify a valid method of identifying the station"
@@ -213,7 +255,7 @@ def is_station_in_database(system_id: str = None, system_name: str = None, stati
 
 
 # Returns the id of the specified system
-def get_system_id(system_name: str) -> str:
+def get_system_id(system_name: str) -> int:
     database = SQLConnection(database_login_info)
 
     database.execute("SELECT system_id FROM systems WHERE name = %s;", (system_name,))
@@ -225,7 +267,7 @@ def get_system_id(system_name: str) -> str:
 
 
 # Returns the body id of the specified market
-def get_station_body_id(market_id: str) -> str:
+def get_station_body_id(market_id: int) -> int:
     database = SQLConnection(database_login_info)
 
     database.execute("SELECT body_id FROM stations WHERE station_id = %s;", (market_id,))
@@ -236,6 +278,81 @@ def get_station_body_id(market_id: str) -> str:
     return body_id
 
 
+# Returns the rows of the last query as dictionaries keyed by column name
+def fetch_dictionaries(database: SQLConnection) -> list[dict]:
+    columns = [column.name for column in database.cursor.description]
+
+    return [dict(zip(columns, row)) for row in database.cursor.fetchall()]
+
+
+# Returns the specified system along with its stations, or None if it has not been logged
+def get_system(system_id: int, pool: psycopg2.pool.ThreadedConnectionPool = None) -> Union[dict, None]:
+    database = SQLConnection(database_login_info, pool)
+
+    try:
+        database.execute("SELECT name, system_id, ST_X(location) AS x, ST_Y(location) AS y, ST_Z(location) AS z "
+                         "FROM systems WHERE system_id = %s;", (system_id,))
+        systems = fetch_dictionaries(database)
+
+        if systems:
+            database.execute("SELECT name, body_id, station_id, distance, station_type, last_updated "
+                             "FROM stations WHERE system_id = %s ORDER BY distance;", (system_id,))
+            systems[0]["stations"] = fetch_dictionaries(database)
+    finally:
+        database.close()
+
+    return systems[0] if systems else None
+
+
+# Returns the specified station, or None if it has not been logged
+def get_station(station_id: int, pool: psycopg2.pool.ThreadedConnectionPool = None) -> Union[dict, None]:
+    database = SQLConnection(database_login_info, pool)
+
+    try:
+        database.execute("SELECT name, body_id, system_id, station_id, distance, station_type, last_updated "
+                         "FROM stations WHERE station_id = %s;", (station_id,))
+        stations = fetch_dictionaries(database)
+    finally:
+        database.close()
+
+    return stations[0] if stations else None
+
+
+# Returns the commodities last logged at the specified station
+def get_market(station_id: int, pool: psycopg2.pool.ThreadedConnectionPool = None) -> list[dict]:
+    database = SQLConnection(database_login_info, pool)
+
+    try:
+        database.execute("SELECT commodity_types.name, buy_price, sell_price, mean_price, units_in_stock, "
+                         "units_in_demand "
+                         "FROM commodities JOIN commodity_types USING (commodity_type_id) "
+                         "WHERE station_id = %s ORDER BY commodity_types.name;", (station_id,))
+        commodities = fetch_dictionaries(database)
+    finally:
+        database.close()
+
+    return commodities
+
+
+# Returns the systems within the specified distance in light years of a system, nearest first
+def get_nearby_systems(system_id: int, radius: float, limit: int = 100,
+                       pool: psycopg2.pool.ThreadedConnectionPool = None) -> list[dict]:
+    database = SQLConnection(database_login_info, pool)
+
+    try:
+        database.execute("SELECT nearby.name, nearby.system_id, "
+                         "ST_3DDistance(nearby.location, origin.location) AS distance "
+                         "FROM systems AS origin JOIN systems AS nearby "
+                         "ON ST_3DDWithin(nearby.location, origin.location, %s) "
+                         "WHERE origin.system_id = %s AND nearby.system_id != origin.system_id "
+                         "ORDER BY distance LIMIT %s;", (radius, system_id, limit))
+        systems = fetch_dictionaries(database)
+    finally:
+        database.close()
+
+    return systems
+
+
 # Inserts the specified system information into the database, it is up to the user to
 # check to ensure the system has not already been logged, otherwise an error may occur
 def update_system_row(system_name: str, system_id: int, location: list,
@@ -247,9 +364,11 @@ def update_system_row(system_name: str, system_id: int, location: list,
 
     database.close()
 
+    query_cache.invalidate(("system", system_id))
+
 
 # Inserts the specified star information into the database
-def update_star_row(star_name: str, body_id: str, system_id: str, star_class: str = "unknown", mass: float = 0,
+def update_star_row(star_name: str, body_id: int, system_id: int, star_class: str = "unknown", mass: float = 0,
                     distance: float = -1,  pool: psycopg2.pool.ThreadedConnectionPool = None) -> None:
     if distance is None:
         distance = -1
@@ -294,7 +413,7 @@ def update_star_row(star_name: str, body_id: str, system_id: str, star_class: st
 
 
 # Inserts the specified planet information into the database
-def update_planet_row(planet_name: str, body_id: str, system_id: str, planet_class: str = "unknown",
+def update_planet_row(planet_name: str, body_id: int, system_id: int, planet_class: str = "unknown",
                       terraforming_state: str = "unknown", mass: float = 0, distance: float = 0,
                       is_discovered: bool = True, is_mapped: bool = True,
                       pool: psycopg2.pool.ThreadedConnectionPool = None) -> None:
@@ -350,7 +469,7 @@ def update_planet_row(planet_name: str, body_id: str, system_id: str, planet_cla
 
 
 # Inserts the specified station information into the database
-def update_station_row(station_name: str, body_id: str, system_id: str, station_id: str, distance: float = -1,
+def update_station_row(station_name: str, body_id: int, system_id: int, station_id: int, distance: float = -1,
                        station_type: str = "unknown", last_updated: datetime = None,
                        pool: psycopg2.pool.ThreadedConnectionPool = None) -> None:
     if distance is None:
@@ -398,17 +517,46 @@ def update_station_row(station_name: str, body_id: str, system_id: str, station_
 
     database.close()
 
+    query_cache.invalidate(("station", station_id), ("system", system_id))
 
-# Inserts the specified commodity information into the database
-def update_commodity_row(commodity_name: str, commodity_id: str, station_id: str, buy_price: int, sell_price: int,
-                         mean_price: int, units_in_stock: int, units_in_demand: int,
+
+# Returns the id of the specified commodity name, registering it in the commodity_types table if it is new
+def get_commodity_type_id(commodity_name: str, pool: psycopg2.pool.ThreadedConnectionPool = None) -> int:
+    commodity_type_id = commodity_type_ids.get(commodity_name)
+
+    if commodity_type_id is not None:
+        return commodity_type_id
+
+    with commodity_type_ids_lock:
+        if commodity_name not in commodity_type_ids:
+            database = SQLConnection(database_login_info, pool)
+
+            try:
+                # Conflicting inserts still draw from the SMALLSERIAL sequence, so only names that are missing are
+                # inserted
+                database.execute("INSERT INTO commodity_types (name) SELECT %(name)s WHERE NOT EXISTS ("
+                                 "SELECT 1 FROM commodity_types WHERE name = %(name)s"
+                                 ") ON CONFLICT (name) DO NOTHING;", {"name": commodity_name})
+                database.execute("SELECT commodity_type_id FROM commodity_types WHERE name = %s;", (commodity_name,))
+                commodity_type_ids[commodity_name] = database.cursor.fetchone()[0]
+            finally:
+                database.close()
+
+        return commodity_type_ids[commodity_name]
+
+
+# Inserts the specified commodity information into the database. This doesn't touch query_cache: callers must
+# invalidate ("market", station_id) themselves once they have finished writing the market, even if a write fails
+def update_commodity_row(commodity_name: str, station_id: int, buy_price: int, sell_price: int, mean_price: int,
+                         units_in_stock: int, units_in_demand: int,
                          pool: psycopg2.pool.ThreadedConnectionPool = None) -> None:
+    commodity_type_id = get_commodity_type_id(commodity_name, pool=pool)
+
     database = SQLConnection(database_login_info, pool)
 
     parameters = {
-        "name": commodity_name,
-        "commodity_id": commodity_id,
         "station_id": station_id,
+        "commodity_type_id": commodity_type_id,
         "buy_price": buy_price,
         "sell_price": sell_price,
         "mean_price": mean_price,
@@ -417,28 +565,29 @@ def update_commodity_row(commodity_name: str, commodity_id: str, station_id: str
     }
 
     database.execute("INSERT INTO commodities VALUES ("
-                     "%(name)s,"
-                     "%(commodity_id)s,"
                      "%(station_id)s,"
+                     "%(commodity_type_id)s,"
                      "%(buy_price)s,"
                      "%(sell_price)s,"
                      "%(mean_price)s,"
                      "%(units_in_stock)s,"
                      "%(units_in_demand)s"
-                     ") ON CONFLICT (commodity_id) DO UPDATE "
+                     ") ON CONFLICT (station_id, commodity_type_id) DO UPDATE "
                      "SET buy_price = %(buy_price)s,"
                      "sell_price = %(sell_price)s,"
                      "mean_price = %(mean_price)s,"
                      "units_in_stock = %(units_in_stock)s,"
                      "units_in_demand = %(units_in_demand)s "
-                     "WHERE commodities.commodity_id = %(commodity_id)s;", parameters)
+                     "WHERE commodities.station_id = %(station_id)s "
+                     "AND commodities.commodity_type_id = %(commodity_type_id)s;", parameters)
 
     database.close()
 
 
 # Inserts the specified information into the logs database
-def insert_log_row(status: str, meta_message: list[str], event_type: str, payload: json, system_of_interest: str,
-                   body_of_interest: str, upload_timestamp: datetime = None,
+def insert_log_row(status: str, meta_message: list[str], event_type: str, payload: json,
+                   system_of_interest: Union[int, str], body_of_interest: Union[int, str],
+                   upload_timestamp: datetime = None,
                    pool: psycopg2.pool.AbstractConnectionPool = None):
     if not upload_timestamp:
         upload_timestamp = datetime.now(timezone.utc)